@@ -14,63 +14,159 @@ from os.path import basename, dirname, exists, isdir, realpath, join, lexists
 import subprocess
 from subprocess import PIPE, STDOUT
 from typing import (Union, Callable, Any, TypeVar, Optional, IO, Generic,
-                    Type, no_type_check, Protocol)
+                    Type, no_type_check, Protocol, Iterable, Iterator,
+                    Mapping)
+import bisect
+import collections
 import contextlib
+import concurrent.futures
+import functools
+import mmap
 import re
+import shlex
+import shutil
+import struct
+import tempfile
+import threading
+
+try:
+    import pygit2  # type: ignore
+except ImportError:
+    pygit2 = None
 
 AnyPath = Union[os.PathLike, str]
+# absolute path to git; subprocess only uses posix_spawn (rather than
+# fork/exec) for executables given with a directory
+GIT = shutil.which('git') or 'git'
+# a full (sha1) object id
+_SHA_RE = re.compile(r'[0-9a-f]{40}\Z')
+# things git check-ref-format forbids in a ref name: `..', `@{', control
+# characters, space ~ ^ : ? * [ \, components starting with `.' or ending
+# with `.lock', empty components, and a trailing `.'
+_BAD_REF_RE = re.compile(r'\.\.|@\{|[\x00-\x20\x7f~^:?*\[\\]|(^|/)\.|'
+                         r'\.lock(/|$)|//|/$|\.$')
+T = TypeVar('T')
+R = TypeVar('R')
 
 
 def fspath(path: AnyPath) -> str:
     return os.fspath(path)
 
 
+def chunk_paths(paths: Iterable[str],
+                chunk_size: int = 4000,
+                env: Optional[Mapping[str, str]] = None
+                ) -> Iterator[list[str]]:
+    """Split paths into lists of at most chunk_size paths, each small enough
+    to be passed as arguments to a single command (run with environment env,
+    default os.environ) without exceeding ARG_MAX"""
+    if env is None:
+        env = os.environ
+    # the kernel counts each argv/envp string, its NUL and its pointer
+    pointer = struct.calcsize('P')
+    # leave room for the environment and the rest of the command line
+    # (git, its options and the repository path)
+    max_argv = (os.sysconf("SC_ARG_MAX") - 8192 -
+                sum(len(os.fsencode(k)) + len(os.fsencode(v)) + 2 + pointer
+                    for k, v in env.items()))
+    chunk: list[str] = []
+    chunk_len = 0
+    for path in paths:
+        path_len = len(os.fsencode(path)) + 1 + pointer
+        if chunk and (len(chunk) >= chunk_size or
+                      chunk_len + path_len > max_argv):
+            yield chunk
+            chunk = []
+            chunk_len = 0
+        chunk.append(path)
+        chunk_len += path_len
+    if chunk:
+        yield chunk
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe_repo_path(path: str) -> tuple[str, bool, str]:
+    """Probe (absolute) path for a git repository.
+    Returns (realpath, bare, gitdir).
+    Raises GitError if path is not a git repository (these results are not
+    cached, so a repository created later is picked up)."""
+    # heuristic: if the path has a .git directory in it, then its not bare
+    # otherwise we assume its a bare repo if
+    # 1) it ends with .git
+    # 2) seems to be initialized (objects and refs directories exist)
+    path = realpath(path)
+    path_git = join(path, ".git")
+    if isdir(path_git):
+        return path, False, path_git
+    elif (path.endswith(".git") and
+          isdir(join(path, "refs")) and
+          isdir(join(path, "objects"))):
+        return path, True, path
+    raise GitError("Not a git repository `%s'" % path)
+
+
+def _probe_repo(path: AnyPath) -> tuple[str, bool, str]:
+    """Cached lookup of (realpath, bare, gitdir) for a git repository"""
+    return _probe_repo_path(os.path.abspath(fspath(path)))
+
+
+def clear_probe_cache() -> None:
+    """Forget cached repository lookups (e.g., after repositories have been
+    moved or removed)"""
+    _probe_repo_path.cache_clear()
+
+
 def is_git_repository(path: AnyPath) -> bool:
     """Return True if path is a git repository"""
-    path = realpath(fspath(path))
-    path_git = join(path, ".git")
-    return isdir(path_git) or \
-        (path.endswith(".git") and
-         isdir(join(path, "refs")) and
-         isdir(join(path, "objects")))
+    try:
+        _probe_repo(path)
+    except GitError:
+        return False
+    return True
 
 
 @no_type_check
 def setup(method):
-    """Decorator that:
-    1) chdirs into git.path
-    2) processes arguments (only non-keywords arguments):
-       stringifies them (except None, True or False)
+    """Decorator that processes arguments (only non-keywords arguments):
        translates all absolute paths inside git.path to be relative to git.path
 
+    Relative arguments are already relative to git.path: git commands run
+    in git.path (git -C) with GIT_DIR=git.gitdir passed to subprocess (the
+    process-wide cwd/environment is left alone).
     """
 
     @no_type_check
     def wrapper(self, *args, **kws):
-        orig_cwd = os.getcwd()
-        os.chdir(self.path)
-        os.environ['GIT_DIR'] = self.gitdir
+        # realpath of each argument's directory, for this call only
+        dircache = {}
+        prefix = self.path + os.sep
 
         def make_relative(arg):
-            if arg is None or isinstance(arg, bool):
+            if arg is None or isinstance(arg, (bool, bytes)):
                 return arg
 
             if not isinstance(arg, str):
                 return list(map(make_relative, arg))
 
-            try:
-                return self.make_relative(arg)
-            except self.GitError:
+            if not os.path.isabs(arg):
                 return arg
 
-        rel_args = list(map(make_relative, args))
+            if arg.startswith(prefix):
+                return arg[len(prefix):].lstrip(os.sep)
 
-        try:
-            ret = method(self, *rel_args, **kws)
-        finally:
-            os.chdir(orig_cwd)
+            argdir = dirname(arg)
+            if argdir not in dircache:
+                dircache[argdir] = realpath(argdir)
+            path = join(dircache[argdir], basename(arg))
+            if path == self.path:
+                return ''
+            if path.startswith(prefix):
+                return path[len(prefix):]
+            return arg
+
+        rel_args = list(map(make_relative, args))
 
-        return ret
+        return method(self, *rel_args, **kws)
 
     return wrapper
 
@@ -79,6 +175,67 @@ class GitError(Exception):
     pass
 
 
+class _PackedRefs(object):
+    """Sorted, in memory copy of a packed-refs file.
+
+    The file is (re)read via mmap whenever its mtime/size/inode change;
+    lookups are a binary search over the ref names.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stamp: Optional[tuple[int, int, int]] = None
+        self._names: list[str] = []
+        self._shas: list[str] = []
+        self._lock = threading.Lock()
+
+    def _load(self) -> tuple[list[str], list[str]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return [], []
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if stamp != self._stamp:
+                refs = []
+                if st.st_size:
+                    with open(self.path, 'rb') as fob, \
+                            mmap.mmap(fob.fileno(), 0,
+                                      access=mmap.ACCESS_READ) as mm:
+                        for line in iter(mm.readline, b''):
+                            # skip the header and peeled (^<sha>) lines
+                            if line[:1] in (b'#', b'^'):
+                                continue
+                            sha, _, name = line.rstrip(b'\n').partition(b' ')
+                            # git allows ref names that aren't utf-8
+                            refs.append((name.decode('utf-8',
+                                                     'surrogateescape'),
+                                         sha.decode('ascii')))
+                refs.sort()
+                self._names = [name for name, sha in refs]
+                self._shas = [sha for name, sha in refs]
+                self._stamp = stamp
+            return self._names, self._shas
+
+    def get(self, ref: str) -> Optional[str]:
+        """Returns object id of packed ref (None if not packed)"""
+        names, shas = self._load()
+        i = bisect.bisect_left(names, ref)
+        if i < len(names) and names[i] == ref:
+            return shas[i]
+        return None
+
+    def list(self, prefix: str) -> list[str]:
+        """Returns names of packed refs starting with prefix"""
+        names, shas = self._load()
+        i = bisect.bisect_left(names, prefix)
+        refs = []
+        while i < len(names) and names[i].startswith(prefix):
+            refs.append(names[i])
+            i += 1
+        return refs
+
+
 class Git(object):
     """Class for interfacing with a git repository.
 
@@ -94,7 +251,7 @@ class Git(object):
         """
 
         def get_path(self, obj: 'Git') -> str:
-            return join(obj.path, ".git", "MERGE_MSG")
+            return obj._merge_msg_path
 
         def __get__(self, obj: 'Git', type: Any) -> Optional[str]:
             path = self.get_path(obj)
@@ -113,11 +270,10 @@ class Git(object):
 
     class IndexLock(object):
         def get_path(self, obj: 'Git') -> str:
-            return join(obj.gitdir, "index.lock")
+            return obj._index_lock_path
 
         def __get__(self, obj: 'Git', type: Any) -> bool:
-            path = self.get_path(obj)
-            return exists(path)
+            return exists(obj._index_lock_path)
 
         def __set__(self, obj: 'Git', val: Any) -> None:
             path = self.get_path(obj)
@@ -136,41 +292,258 @@ class Git(object):
                     bare: bool = False,
                     verbose: bool = False
                     ) -> 'Git':
+        return cls.init_create_batched(path, bare=bare, verbose=verbose)
+
+    @classmethod
+    def init_create_batched(cls: Type['Git'],
+                            path: AnyPath,
+                            remote: Optional[str] = None,
+                            files: Optional[list[str]] = None,
+                            msg: Optional[str] = None,
+                            branch: Optional[str] = None,
+                            bare: bool = False,
+                            verbose: bool = False
+                            ) -> 'Git':
+        """git init, then optionally:
+            git remote add origin <remote>
+            git add -A -- <files>  (all files if files is an empty list)
+            git commit -m <msg>
+            git checkout -b <branch>
+
+        All steps run in a single `/bin/sh -c' call, chained with `&&'.
+        Every argument is passed through shlex.quote() before being joined
+        into the shell command line; any new step must do the same, or
+        paths/messages could be interpreted by the shell.
+        """
+        if bare and (files is not None or msg or branch):
+            raise GitError("can't add, commit or checkout files in a bare "
+                           "repository")
+
         _path = fspath(path)
         if not lexists(_path):
             os.mkdir(_path)
 
-        init_path = _path
+        # every step names the repository explicitly, so that a GIT_DIR
+        # inherited by the caller (e.g., in a hook) can't redirect it
+        abs_path = os.path.abspath(_path)
+        init_path = abs_path
         if not bare:
             init_path = join(init_path, ".git")
+        repo_args = ['--git-dir', init_path]
+        if not bare:
+            repo_args += ['--work-tree', abs_path]
 
-        command = subprocess.run(
-                ['git', '--git-dir', init_path, 'init'],
-                stdout=PIPE, stderr=STDOUT)
-        if command.returncode != 0:
-            raise GitError(command.stdout.decode('utf-8'))
-        elif verbose:
-            print(command.stdout.decode('utf-8'))
+        commands = [[GIT, '--git-dir', init_path, 'init']]
+        if remote:
+            commands.append(['remote', 'add', 'origin', remote])
+        if files is not None:
+            commands.append(['add', '-A', '--', *files])
+        if msg:
+            commands.append(['commit', '-m', msg])
+        if branch:
+            commands.append(['checkout', '-b', branch])
+        for command in commands[1:]:
+            command[:0] = [GIT, '-C', abs_path, *repo_args]
+
+        joined = " && ".join(" ".join(map(shlex.quote, command))
+                             for command in commands)
+        env = {key: val for key, val in os.environ.items()
+               if key not in ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_INDEX_FILE')}
+        try:
+            output = subprocess.run(
+                    ["/bin/sh", "-c", joined],
+                    stdout=PIPE, stderr=STDOUT, close_fds=False, env=env,
+                    check=True).stdout
+        except subprocess.CalledProcessError as e:
+            raise GitError(e.stdout.decode('utf-8'))
+        if verbose:
+            print(output.decode('utf-8'))
 
         return cls(_path)
 
-    def __init__(self, path: AnyPath):
-        # heuristic: if the path has a .git directory in it, then its not bare
-        # otherwise we assume its a bare repo if
-        # 1) it ends with .git
-        # 2) seems to be initialized (objects and refs directories exist)
-        self.path = realpath(fspath(path))
-        path_git = join(self.path, ".git")
-        if isdir(path_git):
-            self.bare = False
-            self.gitdir = path_git
-        elif (self.path.endswith(".git") and
-              isdir(join(self.path, "refs")) and
-              isdir(join(self.path, "objects"))):
-            self.bare = True
-            self.gitdir = self.path
-        else:
-            raise GitError("Not a git repository `%s'" % self.path)
+    def __init__(self, path: AnyPath, backend: str = 'cli'):
+        """backend='pygit2' answers read-only queries (rev_parse, cat_file,
+        merge_base, rev_list) through libgit2 instead of running git; any
+        other operation, or query arguments it can't handle, still run the
+        git command line"""
+        self.path, self.bare, self.gitdir = _probe_repo(path)
+        self._index_lock_path = join(self.gitdir, "index.lock")
+        self._merge_msg_path = join(self.gitdir, "MERGE_MSG")
+        self._alternates_path = join(self.gitdir, "objects/info/alternates")
+
+        self._repo = None
+        if backend == 'pygit2':
+            if pygit2 is None:
+                raise GitError("pygit2 backend requested, but pygit2 is not "
+                               "installed")
+            self._repo = pygit2.Repository(self.gitdir)
+        elif backend != 'cli':
+            raise GitError(f"unknown backend {backend!r}")
+
+        # environment for git commands, built once. LC_ALL=C gives stable
+        # (parseable) output and skips locale loading; GIT_OPTIONAL_LOCKS=0
+        # stops read-only commands (e.g., status) from taking index.lock
+        self._env = {**os.environ, 'GIT_DIR': self.gitdir,
+                     'LC_ALL': 'C', 'GIT_OPTIONAL_LOCKS': '0'}
+
+        # packed-refs is only meaningful for the (default) files ref backend
+        self._packed_refs: Optional[_PackedRefs] = None
+        if not isdir(join(self.gitdir, "reftable")):
+            self._packed_refs = _PackedRefs(join(self.gitdir, "packed-refs"))
+
+        # long lived `git cat-file --batch[-check]' processes, spawned lazily
+        self._catfile_proc: Optional[subprocess.Popen] = None
+        self._catfile_check_proc: Optional[subprocess.Popen] = None
+        self._catfile_lock = threading.Lock()
+
+    def _git_args(self, *args: str) -> list[str]:
+        """command line for git *args, run in self.path.
+
+        git's -C is used rather than passing cwd to subprocess, and callers
+        pass close_fds=False (all our pipes are non-inheritable anyway), so
+        that subprocess can start git with posix_spawn instead of fork/exec.
+        """
+        return [GIT, '-C', self.path, *args]
+
+    def __del__(self) -> None:
+        # __init__ may have raised before the attributes were set
+        if hasattr(self, '_catfile_lock'):
+            self.close()
+
+    def close(self) -> None:
+        """terminate any long lived git processes held by this object"""
+        with self._catfile_lock:
+            for proc in (self._catfile_proc, self._catfile_check_proc):
+                if proc is None:
+                    continue
+                try:
+                    proc.stdin.close()  # type: ignore
+                except IOError:
+                    pass
+                proc.stdout.close()  # type: ignore
+                proc.wait()
+            self._catfile_proc = None
+            self._catfile_check_proc = None
+
+    def _catfile_spawn(self, mode: str) -> subprocess.Popen:
+        """spawn git cat-file <mode> (i.e. --batch or --batch-check)"""
+        return subprocess.Popen(
+                self._git_args('cat-file', mode),
+                stdin=PIPE, stdout=PIPE, close_fds=False, env=self._env)
+
+    @staticmethod
+    def _catfile_request(rev: str) -> bytes:
+        if '\n' in rev:
+            raise GitError(f"invalid object name {rev!r}")
+        return rev.encode('utf-8') + b'\n'
+
+    @staticmethod
+    def _catfile_header(proc: subprocess.Popen, rev: str
+                        ) -> Optional[tuple[str, str, int]]:
+        """read a `<sha> <type> <size>' header line from proc.
+        Returns None if rev is missing (or ambiguous)"""
+        line = proc.stdout.readline()  # type: ignore
+        if not line:
+            raise GitError(f"git cat-file exited unexpectedly ({rev!r})")
+        fields = line.decode('utf-8').rstrip('\n').rsplit(' ', 2)
+        if (len(fields) != 3 or not fields[2].isdigit() or
+                fields[1] not in ('blob', 'tree', 'commit', 'tag')):
+            return None
+        return fields[0], fields[1], int(fields[2])
+
+    def cat_file_batch(self, revs: Iterable[str]
+                       ) -> Iterator[tuple[str, str, bytes]]:
+        """git cat-file --batch, over a single long lived process.
+        Requests are written to git from a separate thread while replies are
+        read, so many objects can be pipelined without deadlocking.
+        Yields (sha, type, contents) for each rev in order; raises GitError
+        if any rev does not exist."""
+        revs = list(revs)
+        requests = b''.join(map(self._catfile_request, revs))
+        with self._catfile_lock:
+            if self._catfile_proc is None:
+                self._catfile_proc = self._catfile_spawn('--batch')
+            proc = self._catfile_proc
+
+            def write() -> None:
+                try:
+                    proc.stdin.write(requests)  # type: ignore
+                    proc.stdin.flush()  # type: ignore
+                except IOError:
+                    pass
+
+            writer = threading.Thread(target=write, daemon=True)
+            writer.start()
+            results = []
+            missing = []
+            try:
+                for rev in revs:
+                    header = self._catfile_header(proc, rev)
+                    if header is None:
+                        missing.append(rev)
+                        continue
+                    sha, type_, size = header
+                    # object contents are followed by a newline
+                    contents = proc.stdout.read(size + 1)  # type: ignore
+                    if len(contents) != size + 1:
+                        raise GitError("git cat-file exited unexpectedly")
+                    results.append((sha, type_, contents[:size]))
+            except GitError:
+                proc.kill()
+                proc.wait()
+                self._catfile_proc = None
+                raise
+            finally:
+                writer.join()
+        if missing:
+            raise GitError(f"objects not found: {' '.join(missing)}")
+        yield from results
+
+    def cat_file_check(self, rev: str) -> Optional[tuple[str, str, int]]:
+        """git cat-file --batch-check, over a single long lived process.
+        Returns (sha, type, size) of rev.
+        Returns None if rev does not exist."""
+        request = self._catfile_request(rev)
+        with self._catfile_lock:
+            if self._catfile_check_proc is None:
+                self._catfile_check_proc = self._catfile_spawn('--batch-check')
+            proc = self._catfile_check_proc
+            proc.stdin.write(request)  # type: ignore
+            proc.stdin.flush()  # type: ignore
+            return self._catfile_header(proc, rev)
+
+    def parallel_map(self,
+                     fn: Callable[[T], R],
+                     iterable: Iterable[T],
+                     max_workers: Optional[int] = None
+                     ) -> list[R]:
+        """Return [fn(item) for item in iterable], running the calls
+        concurrently in a thread pool (of max_workers, default cpu count).
+
+        Only use this for read-only queries (e.g., rev_parse, show_ref,
+        rev_list, cat_file, describe, log); methods that modify the index
+        or refs must not run concurrently.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(fn, iterable))
+
+    def _pygit2_lookup(self, rev: str, peel: Any = None) -> Any:
+        """resolve rev with pygit2 (optionally peeled to type peel).
+        Returns None if rev can't be resolved"""
+        try:
+            obj = self._repo.revparse_single(rev)  # type: ignore
+            if peel is not None:
+                obj = obj.peel(peel)
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+        return obj
+
+    @staticmethod
+    def _is_rev(arg: str) -> bool:
+        """True if arg is a plain revision (not an option or a range)"""
+        return not arg.startswith(('-', '^')) and '..' not in arg
 
     def make_relative(self, path: AnyPath) -> str:
         path = fspath(path)
@@ -185,8 +558,13 @@ class Git(object):
     def _system(self, command: str, *args: str,
                 check_returncode: bool = True) -> int:
         # command should be a list already, but just in case...
-        _command: list[str] = ['git', command, *args]
-        output = subprocess.run(_command, stderr=PIPE)
+        _command: list[str] = self._git_args(command, *args)
+        try:
+            output = subprocess.run(_command, stderr=PIPE, close_fds=False,
+                                    env=self._env)
+        except OSError as e:
+            # e.g., E2BIG
+            raise GitError(f"failed to run git {command}: {e}")
         if check_returncode and output.returncode != 0:
             raise GitError(output.stderr.decode('utf-8'))
         else:
@@ -198,7 +576,10 @@ class Git(object):
 
     def update_index(self, *paths: str) -> None:
         """git update-index --remove <paths>"""
-        self._system("update-index", "--remove", *paths)
+        if not paths:
+            self._system("update-index", "--remove")
+        for chunk in chunk_paths(paths, env=self._env):
+            self._system("update-index", "--remove", "--", *chunk)
 
     def update_index_refresh(self) -> None:
         """git update-index --refresh"""
@@ -208,9 +589,11 @@ class Git(object):
         """update all files that need update according to git update-index
         --refresh"""
         command = subprocess.run(
-                ['git', 'update-index', '--refresh'],
+                self._git_args('update-index', '--refresh'),
                 stdout=PIPE,
                 stderr=STDOUT,
+                close_fds=False,
+                env=self._env,
                 text=True)
         if command.returncode == 0:
             return
@@ -224,6 +607,11 @@ class Git(object):
         # git add chokes on empty directories
         self._system("add", *paths)
 
+    def add_many(self, paths: Iterable[str], chunk_size: int = 4000) -> None:
+        """git add -- <paths>, with as few git calls as ARG_MAX allows"""
+        for chunk in chunk_paths(paths, chunk_size, env=self._env):
+            self._system("add", "--", *chunk)
+
     def checkout(self, *args: str) -> None:
         """git checkout *args"""
         self._system("checkout", *args)
@@ -236,10 +624,11 @@ class Git(object):
         """git update-ref [ -d ] <ref> <rev> [ <oldvalue > ]"""
         self._system("update-ref", *args)
 
-    def rm_cached(self, path: str) -> None:
-        """git rm <path>"""
-        self._system("rm", "--ignore-unmatch", "--cached",
-                     "--quiet", "-f", "-r", path)
+    def rm_cached(self, *paths: str) -> None:
+        """git rm --cached <paths>"""
+        for chunk in chunk_paths(paths, env=self._env):
+            self._system("rm", "--ignore-unmatch", "--cached",
+                         "--quiet", "-f", "-r", "--", *chunk)
 
     def commit(
             self,
@@ -300,27 +689,109 @@ class Git(object):
         else:
             return exitcode
 
-    @setup
     def _getoutput(
             self,
             command: str,
             *args: str,
             check_returncode: bool = True,
-            stderr: Union[int, IO[str]] = STDOUT) -> str:
+            stderr: Union[int, IO[Any]] = STDOUT,
+            decode: str = 'utf-8',
+            rstrip: bool = True) -> str:
+        """git <command> *args -> output
+        Output is decoded in one go once git has exited. Callers that split
+        the output into lines anyway can skip the rstrip."""
+
+        output = self._getoutput_bytes(
+                command, *args, check_returncode=check_returncode,
+                stderr=stderr, decode=decode).decode(decode)
+        if rstrip:
+            return output.rstrip()
+        return output
+
+    @staticmethod
+    def _command_error(err: str, command: str, args: tuple[str, ...]
+                       ) -> GitError:
+        return GitError(
+                err,
+                f'erronous input: {command!r} {" ".join(map(repr, args))}')
+
+    @setup
+    def _iter_lines(
+            self,
+            command: str,
+            *args: str,
+            check_returncode: bool = True) -> Iterator[str]:
+        """git <command> *args
+        Yields lines of output (without newlines) as git produces them"""
+
+        # stderr goes to a file: a pipe that is only read once stdout is
+        # exhausted could fill up and block git (and us) forever
+        with tempfile.TemporaryFile() as errfile:
+            p = subprocess.Popen(
+                    self._git_args(command, *args),
+                    stdout=PIPE,
+                    stderr=errfile,
+                    close_fds=False,
+                    env=self._env,
+                    encoding='utf-8',
+                    bufsize=1)
+            try:
+                for line in p.stdout:  # type: ignore
+                    yield line.rstrip('\n')
+                returncode = p.wait()
+            finally:
+                if p.poll() is None:
+                    # consumer stopped early
+                    p.kill()
+                    p.wait()
+                p.stdout.close()  # type: ignore
+            errfile.seek(0)
+            err = errfile.read().decode('utf-8')
+
+        if check_returncode and returncode != 0:
+            raise self._command_error(err, command, args)
+
+    @setup
+    def _getoutput_bytes(
+            self,
+            command: str,
+            *args: str,
+            check_returncode: bool = True,
+            stderr: Union[int, IO[Any]] = PIPE,
+            decode: str = 'utf-8') -> bytes:
+        """like _getoutput, but returns stdout undecoded and unstripped
+        (decode is only used for the error message)"""
 
         output = subprocess.run(
-                ['git', command, *args],
+                self._git_args(command, *args),
                 stdout=PIPE,
                 stderr=stderr,
-                text=True)
+                close_fds=False,
+                env=self._env)
         if check_returncode and output.returncode != 0:
-            raise GitError(
-                    output.stdout,
-                    f'erronous input: {command!r} {" ".join(map(repr, args))}')
+            err = output.stderr if stderr == PIPE else output.stdout
+            raise self._command_error(err.decode(decode), command, args)
 
-        return output.stdout.rstrip()
+        return output.stdout
 
     def cat_file(self, *args: str) -> str:
+        """git cat-file *args -> output
+
+        cat_file(<type>, <rev>) for blobs, commits and tags is served by the
+        long lived cat-file process (see cat_file_batch)"""
+        if (self._repo is not None and len(args) == 2 and
+                args[0] in ('blob', 'commit', 'tag')):
+            obj = self._pygit2_lookup(args[1])
+            if obj is not None and obj.type_str == args[0]:
+                return obj.read_raw().decode('utf-8').rstrip()
+        if len(args) == 2 and args[0] in ('blob', 'commit', 'tag'):
+            try:
+                sha, type_, contents = next(self.cat_file_batch(args[1:]))
+            except GitError:
+                type_ = None
+            # anything else (e.g., peeling a tag to a commit) is left to git
+            if type_ == args[0]:
+                return contents.decode('utf-8').rstrip()
         return self._getoutput("cat-file", *args)
 
     def write_tree(self) -> str:
@@ -333,6 +804,14 @@ class Git(object):
         Returns object-id of parsed rev.
         Returns None on failure.
         """
+        if args and all(_SHA_RE.match(arg) for arg in args):
+            # git rev-parse echoes full object ids back unchecked
+            return '\n'.join(args)
+        if (self._repo is not None and len(args) == 1 and
+                self._is_rev(args[0])):
+            obj = self._pygit2_lookup(args[0])
+            if obj is not None:
+                return str(obj.id)
         try:
             return self._getoutput("rev-parse", *args)
         except GitError:
@@ -341,6 +820,13 @@ class Git(object):
     def merge_base(self, a: str, b: str) -> Optional[str]:
         """git merge-base <a> <b>.
         Returns common ancestor"""
+        if self._repo is not None:
+            commit_a = self._pygit2_lookup(a, pygit2.Commit)
+            commit_b = self._pygit2_lookup(b, pygit2.Commit)
+            # revs pygit2 can't resolve (or peel to a commit) go to git
+            if commit_a is not None and commit_b is not None:
+                base = self._repo.merge_base(commit_a.id, commit_b.id)
+                return None if base is None else str(base)
         try:
             return self._getoutput("merge-base", a, b)
         except GitError:
@@ -359,12 +845,51 @@ class Git(object):
         """git rev-list <commit>.
         Returns list of commits.
         """
-        output = self._getoutput("rev-list", *args,
-                                 check_returncode=check_returncode)
-        if not output:
-            return []
-        # remove empty lines from list
-        return list(filter(None, output.split('\n')))
+        if (self._repo is not None and len(args) == 1 and
+                self._is_rev(args[0])):
+            commit = self._pygit2_lookup(args[0], pygit2.Commit)
+            if commit is not None:
+                # GIT_SORT_TIME matches rev-list's default (date) order
+                return [str(c.id) for c in
+                        self._repo.walk(commit.id, pygit2.GIT_SORT_TIME)]
+        return self._getoutput("rev-list", *args,
+                               check_returncode=check_returncode,
+                               stderr=PIPE, rstrip=False).splitlines()
+
+    def rev_list_iter(self, *args: str,
+                      check_returncode: bool = True) -> Iterator[str]:
+        """git rev-list <commit>.
+        Yields commits as git lists them.
+        """
+        return self._iter_lines("rev-list", *args,
+                                check_returncode=check_returncode)
+
+    def rev_list_until(self,
+                       predicate: Callable[[str], bool],
+                       start: str = 'HEAD',
+                       initial: int = 32,
+                       cap: int = 4096
+                       ) -> Optional[str]:
+        """Walk git rev-list <start>, returning the first commit for which
+        predicate(commit) is True.
+        Commits are listed in windows of doubling size (initial, 2*initial,
+        ... up to cap commits), so deep searches need only a few git calls.
+        Returns None if no commit within cap commits matches."""
+        if initial < 1 or cap < initial:
+            raise ValueError(f"need 1 <= initial <= cap "
+                             f"(initial={initial}, cap={cap})")
+        n = initial
+        checked = 0
+        while True:
+            commits = self.rev_list(f'--max-count={n}', start)
+            for commit in commits[checked:]:
+                if predicate(commit):
+                    return commit
+            checked = len(commits)
+            if len(commits) < n or n >= cap:
+                # history exhausted, or searched as far as allowed
+                return None
+            n = min(n * 2, cap)
 
     def name_rev(self, rev: str) -> str:
         """git name-rev <rev>
@@ -375,6 +900,21 @@ class Git(object):
         """git show-ref <rev>.
         Returns ref name if succesful
         Returns None on failure"""
+        if (self._packed_refs is not None and ref.startswith("refs/") and
+                not _BAD_REF_RE.search(ref)):
+            # full ref names can be checked without running git; symbolic
+            # refs (which may dangle) are left to git
+            try:
+                with open(join(self.gitdir, ref), 'rb') as fob:
+                    loose: Optional[bytes] = fob.read(5)
+            except (FileNotFoundError, IsADirectoryError,
+                    NotADirectoryError):
+                loose = None
+            if loose is None:
+                if self._packed_refs.get(ref) is not None:
+                    return ref
+            elif loose != b'ref: ':
+                return ref
         try:
             return self._getoutput("show-ref", ref).split(" ")[1]
         except GitError:
@@ -393,17 +933,17 @@ class Git(object):
         """
         return self._getoutput(
                 "describe", *args,
-                check_returncode=False, stderr=PIPE
+                check_returncode=False, stderr=PIPE, rstrip=False
                 ).splitlines()
 
     @setup
     def commit_tree(self,
-                    id: str, log: str,
+                    id: str, log: Union[str, bytes],
                     parents: Union[list[str], str] = None
                     ) -> str:
         """git commit-tree <id> [ -p <parents> ] < <log>
         Return id of object committed"""
-        args = ["git", "commit-tree", id]
+        args = self._git_args("commit-tree", id)
         if parents:
             if not isinstance(parents, (list, tuple)):
                 parents = [parents]
@@ -411,36 +951,24 @@ class Git(object):
             for parent in parents:
                 args += ["-p", parent]
 
-        p = subprocess.Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        try:
-            # p.stdin: Optional[IO[bytes]]
-            p.stdin.write(log)  # type: ignore
-            p.stdin.close()  # type: ignore
-        except IOError:
-            pass
-
-        err = p.wait()
-        if err:
-            raise GitError("git commit-tree failed: {p.stderr.read()!r}")
-        # p.stdout: Optional[IO[bytes]]
-        return p.stdout.read().strip()  # type: ignore
+        if isinstance(log, str):
+            log = log.encode('utf-8')
+        p = subprocess.run(args, input=log, stdout=PIPE, stderr=PIPE,
+                           close_fds=False, env=self._env)
+        if p.returncode != 0:
+            raise GitError(
+                f"git commit-tree failed: {p.stderr.decode('utf-8')}")
+        return p.stdout.decode('utf-8').strip()
 
     def mktree_empty(self) -> str:
         """return an empty tree id which is needed for some comparisons"""
 
-        args = ["git", "mktree"]
-        p = subprocess.Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        try:
-            # p.stdin: Optional[IO[bytes]]
-            p.stdin.close()  # type: ignore
-        except IOError:
-            pass
-
-        err = p.wait()
-        if err:
-            raise GitError("git mktree failed: {p.stderr.read()!r}")
-        # p.stdout: Optional[IO[bytes]]
-        return p.stdout.read().strip()  # type: ignore
+        args = self._git_args("mktree")
+        p = subprocess.run(args, input=b'', stdout=PIPE, stderr=PIPE,
+                           close_fds=False, env=self._env)
+        if p.returncode != 0:
+            raise GitError(f"git mktree failed: {p.stderr.decode('utf-8')}")
+        return p.stdout.decode('utf-8').strip()
 
     @setup
     def log(self, *args: str, oneline: bool = False, count: int = 0) -> str:
@@ -455,6 +983,18 @@ class Git(object):
 
         return self._getoutput(*command, stderr=PIPE)
 
+    def log_iter(self, *args: str, oneline: bool = False, count: int = 0
+                 ) -> Iterator[str]:
+        """git log *args
+        Yields lines of output as git produces them"""
+        command = ['log']
+        if oneline:
+            command.append('--oneline')
+        if count != 0:
+            command.append('-{}'.format(count))
+
+        return self._iter_lines(*command, *args)
+
     def get_latest_tag(self) -> Union[str, bool]:
         """git describe --tags $(git rev-list --tags --max-count=1)
         Returns latest tag. If no tags found, returns False."""
@@ -469,25 +1009,42 @@ class Git(object):
     def get_latest_commit(self, short: bool = True) -> str:
         """git rev-parse [--short] HEAD
         Returns latest commit short ID by default, long ID if short=False."""
-        args = []
-        if short:
-            args.append('--short')
-        args.append('HEAD')
+        if not short:
+            info = self.cat_file_check('HEAD')
+            if info is None:
+                raise GitError('cat_file_check(HEAD) failed!')
+            return info[0]
+        args = ['--short', 'HEAD']
         out = self.rev_parse(*args)
         if out is None:
             raise GitError(f'rev_parse({args}) failed!')
         return out.strip()
 
-    def status(self, *paths: str) -> list[list[str]]:
+    def status(self, *paths: str) -> list[tuple[str, str]]:
         """git diff-index --name-status HEAD
         Returns array of (status, path) changes """
 
         self.update_index_refresh()
-        output = self._getoutput("diff-index", "--ignore-submodules",
-                                 "--name-status", "HEAD", *paths)
-        if output:
-            return [line.split('\t', 1) for line in output.split('\n')]
-        return []
+        raw = self._getoutput_bytes("diff-index", "--ignore-submodules",
+                                    "--name-status", "-z", "HEAD", *paths)
+        # records are `<status>\0<path>\0'
+        parts = raw.decode('utf-8').split('\0')
+        return list(zip(parts[0:-1:2], parts[1::2]))
+
+    @staticmethod
+    def _parse_porcelain(raw: bytes) -> Iterator[tuple[bytes, bytes]]:
+        """parse `git status --porcelain=v1 -z' output.
+        Yields (XY, path) pairs"""
+        records = iter(raw.split(b'\0'))
+        for record in records:
+            if not record:
+                continue
+            code = record[:2]
+            yield code, record[3:]
+            if b'R' in code or b'C' in code:
+                # renames/copies (in either column) are followed by the
+                # original path
+                next(records, None)
 
     def status_full(self, simple: bool = True) -> Union[
             bool, dict[str, list[str]]]:
@@ -497,45 +1054,73 @@ class Git(object):
         While simple=False; returns a dictionary of categories, containing
         lists of files."""
 
-        items: list[str] = list(filter(
-            None, self._getoutput('status', '--porcelain').split('\n')))
+        raw = self._getoutput_bytes('status', '--porcelain=v1', '-z')
         if simple:
-            if len(items) == 0:
-                return True
-            return False
-
-        stati = (('uncommited', 'M  '), ('unstaged', ' M '),
-                 ('untracked', '?? '))
+            return not raw
 
-        def _check_status(item: str) -> tuple[str, str]:
-            for status, prefix in stati:
-                if item.startswith(prefix):
-                    return status, item[len(prefix):]
-            raise GitError(
-                    'Unrecongnized git status prefix in "{}"'.format(item))
-
-        files_sorted: dict[str, list[str]] = {'uncomitted': [],
+        files_sorted: dict[str, list[str]] = {'uncommitted': [],
                                               'unstaged': [],
                                               'untracked': []}
-        for item in items:
-            status, filename = _check_status(item)
-            files_sorted[status].append(filename)
+        # X is the index (staged) status, Y the worktree status; a path
+        # that is both staged and changed again (e.g., MM) is in both lists
+        for code, path in self._parse_porcelain(raw):
+            filename = path.decode('utf-8')
+            if code == b'??':
+                files_sorted['untracked'].append(filename)
+                continue
+            if code[:1] != b' ':
+                files_sorted['uncommitted'].append(filename)
+            if code[1:2] != b' ':
+                files_sorted['unstaged'].append(filename)
         return files_sorted
 
+    def status_fast(self, *paths: str) -> list[tuple[str, str]]:
+        """git status --porcelain -z
+        Returns list of (XY, path) status codes and paths; renames and
+        copies (in either the X or Y column) are reported once, under their
+        new path"""
+        raw = self._getoutput_bytes("status", "--porcelain=v1", "-z", *paths)
+        return [(code.decode('utf-8'), path.decode('utf-8'))
+                for code, path in self._parse_porcelain(raw)]
+
     def list_unmerged(self) -> list[str]:
-        output = self._getoutput("diff", "--name-only", "--diff-filter=U")
-        if output:
-            return output.split('\n')
-        return []
+        return self._getoutput("diff", "--name-only", "--diff-filter=U",
+                               rstrip=False).splitlines()
 
     def get_commit_log(self, committish: str) -> str:
         """Returns commit log text for <committish>"""
 
-        s = self._getoutput("cat-file commit", committish)
+        s = self.cat_file("commit", committish)
         return s[s.index('\n\n') + 2:]
 
     def ls_files(self, *args: str) -> list[str]:
-        return self._getoutput("ls-files", *args).splitlines()
+        return self._getoutput("ls-files", *args, rstrip=False).splitlines()
+
+    def ls_files_iter(self, *args: str) -> Iterator[str]:
+        """git ls-files *args
+        Yields files as git lists them"""
+        return self._iter_lines("ls-files", *args)
+
+    def ls_files_cached_and_others(self, *paths: str
+                                   ) -> tuple[list[str], list[str]]:
+        """git ls-files --cached --others --exclude-standard
+        Returns (tracked, untracked) lists of files, from a single git call"""
+        output = self._getoutput("ls-files", "--cached", "--others",
+                                 "--exclude-standard", "-t", "-z", *paths,
+                                 rstrip=False)
+        cached: list[str] = []
+        others: list[str] = []
+        for record in output.split('\0'):
+            if not record:
+                continue
+            # -t prefixes each file with a status tag; `?' is untracked
+            tag, path = record[0], record[2:]
+            if tag == '?':
+                others.append(path)
+            elif not cached or cached[-1] != path:
+                # unmerged files are listed once per stage
+                cached.append(path)
+        return cached, others
 
     def list_changed_files(self,
                            compared: Union[tuple[str, str], tuple[str], str],
@@ -559,41 +1144,59 @@ class Git(object):
 
         if len(_compared) == 2:
             s = self._getoutput("diff-tree", "-r", "--name-only",
-                                _compared[0], _compared[1], *paths)
+                                _compared[0], _compared[1], *paths,
+                                rstrip=False)
         elif len(_compared) == 1:
             s = self._getoutput("diff-index", "--ignore-submodules", "-r",
-                                "--name-only", _compared[0], *paths)
+                                "--name-only", _compared[0], *paths,
+                                rstrip=False)
         else:
             raise GitError("compared does not contain 1 or 2 elements")
 
-        if s:
-            return s.split('\n')
-        return []
+        return s.splitlines()
 
     def list_refs(self, refpath: str) -> list[str]:
-        try:
-            output = self._getoutput("show-ref", "--", refpath)
-        except GitError as e:
-            if e == '':
-                return []
-            raise
-
-        tags = []
-        regexp = re.compile('^[0-9a-f]+ refs/%s/(.*)' % refpath)
+        """git for-each-ref refs/<refpath>
+        Returns names of refs under refs/<refpath>, relative to it"""
+        prefix = "refs/" + refpath.strip("/")
+        if (self._packed_refs is not None and
+                not self._has_loose_refs(prefix)):
+            return [ref[len(prefix) + 1:]
+                    for ref in self._packed_refs.list(prefix + "/")]
+
+        depth = prefix.count("/") + 1
+        output = self._getoutput("for-each-ref",
+                                 f"--format=%(refname:lstrip={depth})",
+                                 prefix, rstrip=False)
+        # a ref named exactly refs/<refpath> strips to an empty line
+        return [ref for ref in output.splitlines() if ref]
+
+    def _has_loose_refs(self, prefix: str) -> bool:
+        """Returns True if there are any loose (unpacked) refs under
+        <prefix>/"""
+        for dirpath, dirnames, filenames in os.walk(join(self.gitdir, prefix)):
+            if filenames:
+                return True
+        return False
+
+    def ref_map(self, *patterns: str) -> dict[str, str]:
+        """git for-each-ref <patterns>
+        Returns dictionary mapping (full) ref names to object ids, for
+        callers that need to look up many refs with a single git call"""
+        output = self._getoutput("for-each-ref",
+                                 "--format=%(refname) %(objectname)",
+                                 *patterns, rstrip=False)
+        refs = {}
         for line in output.splitlines():
-            m = regexp.match(line)
-            if not m:
-                continue
-            tag = m.group(1)
-            tags.append(tag)
-
-        return tags
+            ref, _, sha = line.rpartition(' ')
+            refs[ref] = sha
+        return refs
 
     def list_heads(self) -> list[str]:
         return self.list_refs("heads")
 
     def list_tags(self) -> list[str]:
-        return self._getoutput("tag").split()
+        return self.list_refs("tags")
 
     def remove_ref(self, ref: str) -> None:
         """deletes refs/<ref> from the git repository"""
@@ -606,7 +1209,7 @@ class Git(object):
         """set alternates path to point to the objects path of the specified
         git object"""
 
-        with open(join(self.gitdir, "objects/info/alternates"), "w") as fob:
+        with open(self._alternates_path, "w") as fob:
             fob.write(join(git.gitdir, "objects") + '\n')
 
     def stash(self) -> Union[str, bool]:
@@ -627,15 +1230,13 @@ class Git(object):
     def remote(self, *args: str, list_all: bool = False
                ) -> Union[str, dict[str, list[str]]]:
         if list_all:
-            result = self._getoutput("remote", "-v")
-            output: dict[str, list[str]] = {}
-            for line in result.split('\n').strip():
-                name, location = line.split('\t')
-                if name in output.keys():
+            result = self._getoutput("remote", "-v", rstrip=False)
+            output: dict[str, list[str]] = collections.defaultdict(list)
+            for line in result.splitlines():
+                name, _, location = line.partition('\t')
+                if name:
                     output[name].append(location)
-                else:
-                    output[name] = [location]
-            return output
+            return dict(output)
         else:
             return self._getoutput("remote", *args)
 
@@ -652,8 +1253,7 @@ class Git(object):
         if append:
             mode = 'a'
         with open(join(path, ".gitignore"), mode) as fob:
-            for line in lines_:
-                fob.write(line+'\n')
+            fob.write(''.join(line + '\n' for line in lines_))
 
     @staticmethod
     def anchor(path: str) -> None: